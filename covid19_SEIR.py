@@ -200,6 +200,47 @@ w                =0.8   # asymptomatic that cure on their own
 # Date to end computations 
 tmax_date = '06/01/21'
 
+# 'full' stores, writes and prints everything; 'summary' only tracks peaks,
+# deaths and capacity overflow, and appends one line to output/summary.dat;
+# 'report' makes figures and output/report.html from the files already in 
+# output/, without running the model
+run_mode = 'full'
+
+# Healthcare capacity. Hospital beds per 1e5 people ('' = not tracked); 
+# ICU beds are country-specific, set below. 
+hospital_beds_per_1e5 = ''
+
+# Capacity-triggered lockdown: confine factor1 of the susceptible when the ICU 
+# demand exceeds icu_lockdown_fraction of the ICU beds, release factor2 of the 
+# confined when it falls below icu_release_fraction ('' = off)
+icu_lockdown_fraction = ''
+icu_release_fraction  = ''
+
+# Vaccination, from vaccination_start m/dd/yy ('' = no vaccination). 
+# vaccination_rate is the fraction of the population vaccinated per day, 
+# given to the age bins in order of priority (oldest first) until 
+# vaccine_uptake of each bin is vaccinated.
+vaccination_start    = ''
+vaccination_rate     = 0.005
+vaccination_priority = np.array([8,7,6,5,4,3,2,1,0])
+vaccine_uptake       = 0.8
+vaccine_efficacy     = 0.9    # protection of the vaccinated against infection
+
+# Waning immunity: the vaccinated and the recovered move to the waned 
+# compartment, susceptible again, after these times (days)
+Tvaccine_immunity = 1e30
+Tnatural_immunity = 1e30
+
+# Transmission after the data ('' = beta frozen at its last value): file with 
+# date (m/dd/yy) and value per line. schedule_kind is 'Rt' (the value is Rt)
+# or 'contact' (the value multiplies the last beta, e.g. mobility relative 
+# to the end of the data); schedule_interpolation is 'step', 'linear', 'pchip'
+# (monotone cubic, stays within the values) or 'spline' (natural cubic, can 
+# overshoot; beta is kept at zero or above).
+schedule_file          = ''
+schedule_kind          = 'contact'
+schedule_interpolation = 'linear'
+
 #
 # The variables above are user-specified if input.in exists in the directory
 #
@@ -216,96 +257,108 @@ if (os.path.isfile(datadir+'input.in')):
 #  Country-specific block 
 #
 
+def get_country_parameters(name):
+    #
+    # lockdown date, median age and ICU beds per 1e5 people, by country.
+    # Countries not in the table get no lockdown date (i.e., today), the 
+    # median age of their pyramid (None here, see select_country) and the 
+    # median ICU capacity of the table.
+    #
+    if (name=="China"):
+        lockdown = '1/23/20'
+        median_age=38.4
+        icu_beds_per_1e5=3.6
+    elif (name== "Korea, South"):
+        lockdown = '2/18/20'        
+        median_age=40.8
+        icu_beds_per_1e5=10.6        
+    elif (name == 'Iran'):    
+        lockdown = '2/22/20'
+        median_age=32.
+        icu_beds_per_1e5=5.3        
+    elif (name == 'Italy'):
+        lockdown = '3/09/20'
+        median_age=47.3
+        icu_beds_per_1e5=12.5        
+    elif (name == 'Denmark'):
+        lockdown = '3/11/20'        
+        median_age=41.6
+        icu_beds_per_1e5=6.7        
+    elif (name == 'Norway'):
+        lockdown = '3/12/20'                       
+        median_age=39.2
+        icu_beds_per_1e5=8.        
+    elif (name == 'Poland'):
+        lockdown = '3/13/20'                               
+        median_age=39.7
+        icu_beds_per_1e5=6.9        
+    elif (name=="Spain"):
+        lockdown = '3/14/20'
+        median_age=43.1
+        icu_beds_per_1e5=9.7        
+    elif (name=="US"):
+        lockdown = '3/19/20'
+        median_age=38.2
+        icu_beds_per_1e5=34.7        
+    elif (name=="Sweden"):
+        lockdown = ''
+        median_age=40.9
+        icu_beds_per_1e5=5.8        
+    elif (name=="Brazil"):
+        lockdown='3/24/20'
+        median_age=31.4
+        icu_beds_per_1e5=18.        
+    elif (name=="Tunisia"):
+        lockdown ='3/22/20'
+        median_age=31.3
+        icu_beds_per_1e5=2.72        
+    elif (name=="Germany"):
+        lockdown = ''  
+        median_age=45.9
+        icu_beds_per_1e5=29.2        
+    elif (name=="Japan"):
+        lockdown = '' 
+        median_age=47.3
+        icu_beds_per_1e5=7.3        
+    elif (name=="France"):
+        lockdown = ''  
+        median_age=41.2
+        icu_beds_per_1e5=11.6        
+    elif (name=='Ireland'):
+        lockdown = ''  
+        median_age=36.5
+        icu_beds_per_1e5=6.5        
+    elif (name=='Uruguay'):   
+        lockdown= ''
+        median_age=34.9
+        icu_beds_per_1e5=6.        
+    elif (name=='Chile'):
+        lockdown= ''
+        median_age=33.8   
+        icu_beds_per_1e5=6.        
+    elif (name=='India'):
+        lockdown= ''
+        median_age=26.8
+        icu_beds_per_1e5=5.2        
+    elif (name=='United Kingdom'):
+        lockdown= ''
+        median_age=26.8
+        icu_beds_per_1e5=6.6        
+    elif (name=='Switzerland'):
+        lockdown= ''
+        median_age=26.8
+        icu_beds_per_1e5=11.        
+    else:
+        lockdown = ''
+        median_age=None
+        icu_beds_per_1e5=6.9
+    return lockdown,median_age,icu_beds_per_1e5
+
 D0=1. #initial number of dead to start computations. Not 1 only for China (overwritten
 name=country_name
 if (name=="China"):
-    lockdown = '1/23/20'
     D0=min(deaths)
-    median_age=38.4
-    icu_beds_per_1e5=3.6
-elif (name== "Korea, South"):
-    lockdown = '2/18/20'        
-    median_age=40.8
-    icu_beds_per_1e5=10.6        
-elif (name == 'Iran'):    
-    lockdown = '2/22/20'
-    median_age=32.
-    icu_beds_per_1e5=5.3        
-elif (name == 'Italy'):
-    lockdown = '3/09/20'
-    median_age=47.3
-    icu_beds_per_1e5=12.5        
-elif (name == 'Denmark'):
-    lockdown = '3/11/20'        
-    median_age=41.6
-    icu_beds_per_1e5=6.7        
-elif (name == 'Norway'):
-    lockdown = '3/12/20'                       
-    median_age=39.2
-    icu_beds_per_1e5=8.        
-elif (name == 'Poland'):
-    lockdown = '3/13/20'                               
-    median_age=39.7
-    icu_beds_per_1e5=6.9        
-elif (name=="Spain"):
-    lockdown = '3/14/20'
-    median_age=43.1
-    icu_beds_per_1e5=9.7        
-elif (name=="US"):
-    lockdown = '3/19/20'
-    median_age=38.2
-    icu_beds_per_1e5=34.7        
-elif (name=="Sweden"):
-    lockdown = ''
-    median_age=40.9
-    icu_beds_per_1e5=5.8        
-elif (name=="Brazil"):
-    lockdown='3/24/20'
-    median_age=31.4
-    icu_beds_per_1e5=18.        
-elif (name=="Tunisia"):
-    lockdown ='3/22/20'
-    median_age=31.3
-    icu_beds_per_1e5=2.72        
-elif (name=="Germany"):
-    lockdown = ''  
-    median_age=45.9
-    icu_beds_per_1e5=29.2        
-elif (name=="Japan"):
-    lockdown = '' 
-    median_age=47.3
-    icu_beds_per_1e5=7.3        
-elif (name=="France"):
-    lockdown = ''  
-    median_age=41.2
-    icu_beds_per_1e5=11.6        
-elif (name=='Ireland'):
-    lockdown = ''  
-    median_age=36.5
-    icu_beds_per_1e5=6.5        
-elif (name=='Uruguay'):   
-    lockdown= ''
-    median_age=34.9
-    icu_beds_per_1e5=6.        
-elif (name=='Chile'):
-    lockdown= ''
-    median_age=33.8   
-    icu_beds_per_1e5=6.        
-elif (name=='India'):
-    lockdown= ''
-    median_age=26.8
-    icu_beds_per_1e5=5.2        
-elif (name=='United Kingdom'):
-    lockdown= ''
-    median_age=26.8
-    icu_beds_per_1e5=6.6        
-elif (name=='Switzerland'):
-    lockdown= ''
-    median_age=26.8
-    icu_beds_per_1e5=11.        
-else:
-    print("choose a valid country")
-    sys.exit()
+lockdown,median_age,icu_beds_per_1e5 = get_country_parameters(name)
 
 
 # In[3]:
@@ -338,9 +391,19 @@ fatality_rate_age            = .01*np.array([0.002,0.006,0.03,0.08,0.15,0.60,2.2
 hospitalization_fraction_age = .01*np.array([0.1,0.3,1.2,3.2,4.9,10.2,16.6,24.3,27.3])
 critical_care_age            = .01*np.array([5,5,5,5,6.3,12.2,27.4,43.2,70.9])
 #icu_fraction_age             =  hospitalization_fraction_age*critical_care_age
+# unscaled copies, for the scale factors of set_parameters
+london_tables = dict([('fatality_rate_age',fatality_rate_age),
+                      ('hospitalization_fraction_age',hospitalization_fraction_age),
+                      ('critical_care_age',critical_care_age)])
 
 q = hospitalization_fraction_age
 gammap = gamma + (1-q)*xi
+
+#
+# Compartments, in the order they are stored in the state array; 
+# V are the vaccinated and W the waned (formerly immune, susceptible again)
+#
+compartments = ['S','C','E','A','I','Q','H','R','F','V','W']
     
 SMALL_SIZE = 16
 MEDIUM_SIZE = 18
@@ -374,7 +437,7 @@ def date_to_time(d):
     date=np.zeros(n)
     for i in range(n):
         date_object = datetime.datetime.strptime(d[i], '%m/%d/%y')
-        date[i] = datetime.datetime.fromisoformat(np.str(date_object)).timestamp()
+        date[i] = datetime.datetime.fromisoformat(str(date_object)).timestamp()
                   
     return (date-date[n-1])/86400.                
 
@@ -382,27 +445,84 @@ def date_to_time(d):
 
 def date_to_time_scl(d,d0):  
     date1             = datetime.datetime.fromisoformat(
-                        np.str(datetime.datetime.strptime(d, '%m/%d/%y'))
+                        str(datetime.datetime.strptime(d, '%m/%d/%y'))
                         ).timestamp()
     time              = (date1-d0)/86400.
     return time;
 
 #################################################################    
     
-def calc_doubling_time(time,cases):
-
-    exponential_slope = np.gradient(np.log(1.0*cases+1e-10),time) 
+def calc_doubling_time(time,cases,min_count=None):
+    #
+    # cases can be a single series or a (country x date) matrix;
+    # the derivative is taken along the last (date) axis. With min_count,
+    # days where the gradient uses a count below it are NaN.
+    #
+    exponential_slope = np.gradient(np.log(1.0*cases+1e-10),time,axis=-1) 
+    if (min_count is not None):
+        exponential_slope[too_few(cases,min_count)] = np.nan
 
-    n=len(exponential_slope)
-    doubling_time=np.zeros(n)
-    for i in range(n):
-        if (exponential_slope[i] != 0):
-            doubling_time[i] = np.log(2.)/exponential_slope[i]
-        else:
-            doubling_time[i]=0.0
+    doubling_time=np.zeros(np.shape(exponential_slope))
+    nonzero=(exponential_slope != 0)
+    doubling_time[nonzero] = np.log(2.)/exponential_slope[nonzero]
     
     return doubling_time
 
+#################################################################    
+
+def too_few(counts,min_count):
+    #
+    # True where np.gradient along the last axis uses a count that is 
+    # zero or below min_count: the day itself or either neighbour
+    #
+    low = (counts <= 0) | (counts < min_count)
+    mask = low.copy()
+    mask[...,1:]  |= low[...,:-1]
+    mask[...,:-1] |= low[...,1:]
+    return mask
+
+#################################################################    
+
+def rolling_mean(x,window):
+    #
+    # Trailing moving average along the last axis, via cumulative sums.
+    # The first window-1 points average over the available days only.
+    #
+    x=np.asarray(x,dtype=float)
+    n=x.shape[-1]
+    csum=np.zeros(x.shape[:-1]+(n+1,))
+    csum[...,1:]=np.cumsum(x,axis=-1)
+    right=np.arange(1,n+1)
+    left=np.maximum(right-window,0)
+    return (csum[...,right]-csum[...,left])/(right-left)
+
+#################################################################    
+
+def calc_growth_rate(time,cases,window=7,min_count=1.):
+    #
+    # Exponential growth rate (per day) of the smoothed daily incidence, 
+    # from the cumulative counts. Works on a series or a (country x date) matrix.
+    # NaN where the smoothed incidence is below min_count per day, since 
+    # the log of a few counts (or none) jumps at every new case.
+    #
+    incidence=np.zeros(np.shape(cases))
+    incidence[...,1:]=np.maximum(np.diff(1.0*cases,axis=-1),0.)
+    smoothed=rolling_mean(incidence,window)
+    growth_rate=np.gradient(np.log(smoothed+1e-10),time,axis=-1)
+    growth_rate[too_few(smoothed,min_count)]=np.nan
+    return growth_rate
+
+#################################################################    
+
+def calc_Rt(growth_rate):
+    #
+    # Reproduction number for an SEIR model with exponential 
+    # incubation and infectious periods (Wallinga & Lipsitch 2007).
+    # It only holds for growth_rate > -1/Tincubation; NaN below that.
+    #
+    Rt=(1+growth_rate*Tincubation)*(1+growth_rate*Tinfection)
+    return np.where(1+growth_rate*max(Tincubation,Tinfection) > 0, Rt, np.nan)
+
 #################################################################
 
 def get_fatality_rate(age):
@@ -410,6 +530,17 @@ def get_fatality_rate(age):
 
 #################################################################
 
+def get_median_age(age):
+    #
+    # From the 10-year brackets of the pyramid, linear within the bracket
+    #
+    cumulative = np.cumsum(age)/np.sum(age)
+    i = np.searchsorted(cumulative,0.5)
+    below = cumulative[i-1] if i > 0 else 0.
+    return 10.*(i + (0.5-below)/(cumulative[i]-below))
+
+#################################################################
+
 def read_jhu_data(country,mode):
     import csv
     base='/Users/wlyra/covid19/jhudata/time_series_covid19_' 
@@ -427,12 +558,66 @@ def read_jhu_data(country,mode):
                     for i in range(len(dates)):
                         if (row[i+4]==''): 
                             row[i+4]='0'                        
-                        data[dates[i]] += np.int(row[i+4])
+                        data[dates[i]] += int(row[i+4])
     
     return data,dates                
 
 #################################################################    
 
+def read_jhu_matrix(mode):
+    #
+    # Reads a global JHU file in one pass, summing the provinces of each 
+    # country. Returns the sorted country names, the dates and the 
+    # (country x date) matrix of counts.
+    #
+    import csv
+    base=datadir+'jhudata/time_series_covid19_'
+    with open(base+mode+'_global.csv', newline='') as csvfile:    
+        rows=list(csv.reader(csvfile, delimiter=','))
+    
+    return parse_jhu_rows(rows)
+
+#################################################################    
+
+def parse_jhu_rows(rows,first=0):
+    #
+    # rows of a global JHU file, header included; only the dates from 
+    # the first-th on are converted
+    #
+    dates=rows[0][4+first:]
+    rows=rows[1:]
+    countries,index=np.unique([row[1] for row in rows],return_inverse=True)
+    values=np.array([row[4+first:] for row in rows])
+    values[values=='']='0'
+    data=np.zeros((len(countries),len(dates)))
+    np.add.at(data,index,values.astype(float))
+    
+    return list(countries),dates,data
+
+#################################################################    
+
+def screen_countries(mode='deaths',window=7,min_count=1.):
+    #
+    # Doubling time, growth rate and Rt for every country in the JHU 
+    # files at once, as (country x date) matrices. Days with fewer than
+    # min_count (smoothed) daily cases are NaN: unknown, not Rt=1.
+    #
+    countries,dates,cases = read_jhu_matrix(mode)
+    days_past = date_to_time(dates)
+    smoothed  = rolling_mean(cases,window)
+    growth_rate = calc_growth_rate(days_past,cases,window,min_count)
+    
+    screen = dict([('countries',countries),
+                   ('dates',dates),
+                   ('days past',days_past),
+                   ('cases',cases),
+                   ('doubling time',calc_doubling_time(days_past,smoothed,min_count)),
+                   ('growth rate',growth_rate),
+                   ('Rt',calc_Rt(growth_rate))])
+    return screen
+
+#################################################################    
+
 def read_jhu_data_pandas(country,mode):
     import csv
     import pandas as pd
@@ -470,13 +655,19 @@ def read_population_pyramid_data(country):
     else:
         file='/Users/wlyra/covid19/popdata/'+country+'-2019.csv' 
 #
+    return read_age_brackets(file)
+
+#################################################################    
+
+def read_age_brackets(file):
+    import csv
     with open(file, newline='') as csvfile:    
         datareader = csv.reader(csvfile)#, delimiter=',', quotechar='|')
         #data = {} 
         population=[]
         for row in datareader:
             if (row[0] != 'Age'):
-                population.append(np.int(row[1])+np.int(row[2]))
+                population.append(int(row[1])+int(row[2]))
     
     pop=np.array(population)
     age_brackets=np.zeros(9)
@@ -490,6 +681,314 @@ def read_population_pyramid_data(country):
   
 #################################################################    
 
+def build_dataset(dirname=datadir+'dataset'):
+    #
+    # One-time conversion of jhudata/ and popdata/ into aligned binary
+    # arrays plus a small index, to be opened with open_dataset by any 
+    # number of worker processes. The counts are stored date-major, one 
+    # row of all the countries per date, so ingest_jhu_updates can append 
+    # new dates; the pyramids are (country x age bin).
+    #
+    import json
+    import glob
+    if not os.path.exists(dirname):
+        os.mkdir(dirname)
+
+    countries,dates,confirmed = read_jhu_matrix('confirmed')
+    index = dict([(name,i) for i,name in enumerate(countries)])
+    save_rows(dirname+'/confirmed.bin',confirmed.T)
+    for mode in ['deaths','recovered']:
+        names,dates_,data = read_jhu_matrix(mode)
+        if (dates_ != dates):
+            print("dates in the "+mode+" file do not match the confirmed file")
+            sys.exit()
+        #align the rows on the confirmed file
+        aligned = np.zeros((len(countries),len(dates)))
+        for i,name in enumerate(names):
+            if name in index:
+                aligned[index[name]] = data[i]
+        save_rows(dirname+'/'+mode+'.bin',aligned.T)
+
+    # population pyramids; NaN for the countries without popdata
+    file_names = dict([('SKorea','Korea, South'),
+                       ('UK','United Kingdom'),
+                       ('KSA','Saudi Arabia')])
+    age = np.full((len(countries),9),np.nan)
+    for file in glob.glob(datadir+'popdata/*-2019.csv'):
+        name = os.path.basename(file)[:-len('-2019.csv')]
+        name = file_names.get(name,name)
+        if name in index:
+            age[index[name]] = read_age_brackets(file)
+    np.save(dirname+'/age.npy',age)
+
+    with open(dirname+'/index.json','w') as g:
+        json.dump(dict([('countries',countries),('dates',dates)]),g)
+
+#################################################################    
+
+def open_dataset(dirname=datadir+'dataset'):
+    #
+    # The arrays are memory-mapped read-only, so workers opening the same
+    # dataset share one physical copy through the page cache, and slicing
+    # a country does not copy anything. The counts are mapped up to the
+    # dates in index.json and transposed to (country x date).
+    #
+    import json
+    with open(dirname+'/index.json') as g:
+        index = json.load(g)
+    shape = (len(index['dates']),len(index['countries']))
+    dataset = dict([('countries',index['countries']),
+                    ('dates',index['dates']),
+                    ('index',dict([(name,i) for i,name in enumerate(index['countries'])])),
+                    ('days_past',date_to_time(index['dates'])),
+                    ('age',np.load(dirname+'/age.npy',mmap_mode='r'))])
+    for key in ['confirmed','deaths','recovered']:
+        dataset[key] = np.memmap(dirname+'/'+key+'.bin',dtype=float,mode='r',shape=shape).T
+    return dataset
+
+#################################################################    
+
+def get_country_from_dataset(dataset,name):
+    if name not in dataset['index']:
+        print("country "+name+" not in the dataset")
+        sys.exit()
+    i = dataset['index'][name]
+    if not np.isfinite(dataset['age'][i]).all():
+        print("no population pyramid for "+name+" in popdata")
+        sys.exit()
+    country = dict([('name',name),
+                    ('dates',dataset['dates']),
+                    ('days past',dataset['days_past']),
+                    ('confirmed',dataset['confirmed'][i]),
+                    ('recovered',dataset['recovered'][i]),
+                    ('deaths',dataset['deaths'][i]),
+                    ('age',dataset['age'][i])])
+    return country
+
+#################################################################    
+
+def get_dataset_countries(dataset,D0=1.):
+    #
+    # The countries that can be run from the dataset: with a population 
+    # pyramid and at least D0 deaths
+    #
+    index = dataset['index']
+    return [name for name in dataset['countries'] 
+            if np.isfinite(dataset['age'][index[name]]).all() and 
+               dataset['deaths'][index[name]].max() >= D0]
+
+#################################################################    
+
+def local_source(dirname=datadir+'jhudata/'):
+    #
+    # Sources for ingest_jhu_updates: functions taking a JHU file name and 
+    # returning its text. Anything with that signature can stand in.
+    #
+    def fetch(filename):
+        with open(dirname+filename, newline='') as g:
+            return g.read()
+    return fetch
+
+def http_source(base='https://raw.githubusercontent.com/CSSEGISandData/COVID-19/master/csse_covid_19_data/csse_covid_19_time_series/'):
+    from urllib.request import urlopen
+    def fetch(filename):
+        with urlopen(base+filename) as g:
+            return g.read().decode('utf-8')
+    return fetch
+
+#################################################################    
+
+def fetch_jhu_file(source,mode,dates,first):
+    #
+    # Fetches one JHU file, checking that its dates extend `dates`, and 
+    # converts the dates from the first-th on. Returns the countries, 
+    # all the dates of the file and the (country x converted date) counts.
+    #
+    import csv
+    import io
+    text = source('time_series_covid19_'+mode+'_global.csv')
+    rows = list(csv.reader(io.StringIO(text), delimiter=','))
+    header_dates = rows[0][4:]
+    if (header_dates[:len(dates)] != dates):
+        print("dates in the new "+mode+" file do not extend the dataset; rebuild it with build_dataset")
+        sys.exit()
+    countries,_,data = parse_jhu_rows(rows,first)
+    return countries,header_dates,data
+
+#################################################################    
+
+def save_array(file,array):
+    # write and rename, so processes that have the old file mapped keep it
+    np.save(file+'.tmp.npy',array)
+    os.replace(file+'.tmp.npy',file)
+
+def save_rows(file,rows):
+    # same, for the raw date-major files
+    np.ascontiguousarray(rows,dtype=float).tofile(file+'.tmp')
+    os.replace(file+'.tmp',file)
+
+def write_rows(file,rows,start):
+    #
+    # Writes the date-major rows from row `start` on, in place, and drops 
+    # anything after them (left by an ingest that stopped before updating
+    # index.json). Readers map only the rows in index.json, so appended 
+    # rows are invisible to them until it is updated.
+    #
+    rows = np.ascontiguousarray(rows,dtype=float)
+    with open(file,'r+b') as g:
+        g.seek(start*rows.shape[1]*rows.itemsize)
+        rows.tofile(g)
+        g.truncate()
+
+#################################################################    
+
+def get_country_checksum(dataset,name,days):
+    #
+    # Checksum of what a run of the country takes from the dataset: the 
+    # deaths of the first `days` dates, and the pyramid. The confirmed
+    # cases only enter the doubling time, which the model does not use.
+    #
+    import hashlib
+    i = dataset['index'][name]
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(dataset['deaths'][i,:days]).tobytes())
+    h.update(np.ascontiguousarray(dataset['age'][i]).tobytes())
+    return h.hexdigest()
+
+#################################################################    
+
+def register_run(key,name,dirname=datadir+'dataset'):
+    #
+    # Records which country data a run (e.g. its output files) was made 
+    # from: the number of dates and their checksum, so that 
+    # ingest_jhu_updates can tell revised data from newer data
+    #
+    import json
+    dataset = open_dataset(dirname)
+    runs = read_runs(dirname)
+    days = len(dataset['dates'])
+    runs[key] = dict([('country',name),
+                      ('days',days),
+                      ('checksum',get_country_checksum(dataset,name,days)),
+                      ('valid',True),
+                      ('new days',0)])
+    with open(dirname+'/runs.json.tmp','w') as g:
+        json.dump(runs,g)
+    os.replace(dirname+'/runs.json.tmp',dirname+'/runs.json')
+
+def read_runs(dirname=datadir+'dataset'):
+    import json
+    if not os.path.isfile(dirname+'/runs.json'):
+        return {}
+    with open(dirname+'/runs.json') as g:
+        return json.load(g)
+
+#################################################################    
+
+def ingest_jhu_updates(source=None,dirname=datadir+'dataset',revision_window=30):
+    #
+    # Brings the dataset of build_dataset up to the JHU files of `source` 
+    # (local_source by default): the dates all three files share are 
+    # appended, and revised values of the last `revision_window` dates 
+    # replace the stored ones. Only those dates are converted; revisions
+    # further back need a build_dataset. The three files are fetched and 
+    # parsed concurrently. Revised rows are rewritten in place, so a 
+    # process that has the dataset open sees them.
+    # Registered runs whose own data (see get_country_checksum) was revised
+    # are marked invalid; their keys are returned. Runs that only have newer
+    # days available stay valid, with the number of those days in 'new days'.
+    #
+    import json
+    from concurrent.futures import ThreadPoolExecutor
+    if (source is None):
+        source = local_source()
+
+    dataset = open_dataset(dirname)
+    dates   = dataset['dates']
+    first   = max(len(dates)-revision_window,0)
+    modes   = ['confirmed','deaths','recovered']
+    with ThreadPoolExecutor(max_workers=len(modes)) as pool:
+        parsed = list(pool.map(lambda mode: fetch_jhu_file(source,mode,dates,first),modes))
+
+    # a file that is ahead of the others waits for them
+    nd = min(len(new_dates) for _,new_dates,_ in parsed)
+    all_dates = parsed[0][1][:nd]
+    for mode,(_,new_dates,_) in zip(modes,parsed):
+        if (len(new_dates) > nd):
+            print("the "+mode+" file has days after "+all_dates[-1]+"; they wait for the other files")
+
+    countries = list(dataset['countries'])
+    index     = dict(dataset['index'])
+    for names,_,_ in parsed:
+        for name in names:
+            if name not in index:
+                index[name] = len(countries)
+                countries.append(name)
+    old = len(dataset['countries'])
+    nc  = len(countries)
+
+    # (date x country) rows from `first` on
+    blocks  = {}
+    revised = set()
+    start   = {}
+    for mode,(names,_,data) in zip(modes,parsed):
+        stored = dataset[mode][:,first:].T
+        block = np.zeros((nd-first,nc))
+        block[:len(dates)-first,:old] = stored
+        for i,name in enumerate(names):
+            block[:,index[name]] = data[i,:nd-first]
+        changed = (block[:len(dates)-first,:old] != stored)
+        revised.update(countries[i] for i in np.flatnonzero(changed.any(axis=0)))
+        rows = np.flatnonzero(changed.any(axis=1))
+        start[mode] = first+rows[0] if len(rows) > 0 else len(dates)
+        blocks[mode] = block
+    if (nd == len(dates) and len(revised) == 0 and nc == old):
+        print("dataset is up to date")
+        return []
+
+    for mode in modes:
+        file = dirname+'/'+mode+'.bin'
+        if (nc > old):
+            # new countries widen every row: rewrite the file
+            rows = np.zeros((nd,nc))
+            rows[:first,:old] = dataset[mode][:,:first].T
+            rows[first:] = blocks[mode]
+            save_rows(file,rows)
+        else:
+            write_rows(file,blocks[mode][start[mode]-first:],start[mode])
+    if (nc > old):
+        age = np.full((nc,9),np.nan)
+        age[:old] = dataset['age']
+        save_array(dirname+'/age.npy',age)
+    with open(dirname+'/index.json.tmp','w') as g:
+        json.dump(dict([('countries',countries),('dates',all_dates)]),g)
+    os.replace(dirname+'/index.json.tmp',dirname+'/index.json')
+    if (nd > len(dates)):
+        print("added ",nd-len(dates)," days to the dataset, up to ",all_dates[-1])
+    if (len(revised) > 0):
+        print("revised earlier days of ",len(revised)," countries")
+
+    # invalidate the runs made from data that has been revised
+    dataset = open_dataset(dirname)
+    runs = read_runs(dirname)
+    invalid = []
+    for key in runs:
+        run = runs[key]
+        run['new days'] = nd-run['days']
+        if (run['valid'] and run['country'] in revised and
+            get_country_checksum(dataset,run['country'],run['days']) != run['checksum']):
+            run['valid'] = False
+            invalid.append(key)
+    with open(dirname+'/runs.json.tmp','w') as g:
+        json.dump(runs,g)
+    os.replace(dirname+'/runs.json.tmp',dirname+'/runs.json')
+    if (len(invalid) > 0):
+        print("runs made from revised data: ",invalid)
+    
+    return invalid
+
+#################################################################    
+
 def appendvalues(S,C,E,A,I,Q,H,U,R,F,D,t,SS,CC,EE,AA,II,QQ,HH,UU,RR,FF,DD,tt):
     SS.append(S)
     CC.append(C)    
@@ -581,30 +1080,49 @@ def get_data_country(name):
 # In[6]:
 
 
-def select_country(name):
+def select_country(name,dataset=None):
     
     import csv
     #import urllib2
     from urllib.request import urlopen
     
-    dict_confirmed,dates = read_jhu_data(name,'confirmed')
-    dict_deaths,dates    = read_jhu_data(name,'deaths')
+    if (dataset is not None):
+        # memory-mapped data from build_dataset/open_dataset
+        data      = get_country_from_dataset(dataset,name)
+        dates     = data['dates']
+        confirmed = data['confirmed']
+        deaths    = data['deaths']
+        age       = data['age']
+    else:
+        dict_confirmed,dates = read_jhu_data(name,'confirmed')
+        dict_deaths,dates    = read_jhu_data(name,'deaths')
     
-    n1=len(dict_confirmed.keys())
-    n2=len(dict_deaths.keys())    
-    if (n1!=n2):
-        sys.exit()
+        n1=len(dict_confirmed.keys())
+        n2=len(dict_deaths.keys())    
+        if (n1!=n2):
+            sys.exit()
     
-    confirmed=np.zeros(len(dates))
-    deaths   =np.zeros(len(dates))
-    for i in range(len(dates)):
-        confirmed[i] = dict_confirmed[dates[i]]
-        deaths[i]    = dict_deaths[dates[i]]
+        confirmed=np.zeros(len(dates))
+        deaths   =np.zeros(len(dates))
+        for i in range(len(dates)):
+            confirmed[i] = dict_confirmed[dates[i]]
+            deaths[i]    = dict_deaths[dates[i]]
 
-    age=read_population_pyramid_data(name)    
+        age=read_population_pyramid_data(name)    
     N=np.sum(age)
     fatality_rate            = np.sum(fatality_rate_age           *age)/np.sum(age)
-    number_of_icu_beds=icu_beds_per_1e5 * N / 1e5  
+    if (name==country_name):
+        # as set (and possibly changed) in the country-specific block
+        lockdown_,median_age_,icu_beds_per_1e5_ = lockdown,median_age,icu_beds_per_1e5
+    else:
+        lockdown_,median_age_,icu_beds_per_1e5_ = get_country_parameters(name)
+    if (median_age_ is None):
+        median_age_ = get_median_age(age)
+    number_of_icu_beds=icu_beds_per_1e5_ * N / 1e5  
+    if (hospital_beds_per_1e5!=''):
+        number_of_hospital_beds=hospital_beds_per_1e5 * N / 1e5
+    else:
+        number_of_hospital_beds=''
 
     
     # picks the day of the first death to start the integration; 
@@ -629,10 +1147,11 @@ def select_country(name):
                     ('deaths',deaths),
                     ('time_D0',time_D0),
                     ('index_D0',index_D0),
-                    ('lockdown',lockdown),
+                    ('lockdown',lockdown_),
                     ('fatality_rate',fatality_rate),
-                    ('median_age',median_age),
+                    ('median_age',median_age_),
                     ('number_of_icu_beds',number_of_icu_beds),
+                    ('number_of_hospital_beds',number_of_hospital_beds),
                     ('age',age)
                    ])
     
@@ -642,23 +1161,369 @@ def select_country(name):
 # In[7]:
 
 
-def RK3(f):
+def make_snapshot(it,t,dt,Rt,X,U,D,G,auto_lockdown=False,copy=True):
+    #
+    # Copies of the age-binned state, so that consumers of the stream can 
+    # keep them while the integrator keeps updating its arrays in place.
+    # With copy=False the arrays are views, only valid until the next step.
+    # G is the cumulative number of vaccine doses.
+    #
+    if (copy):
+        X,U,D,G = X.copy(),U.copy(),D.copy(),G.copy()
+    snapshot = dict([('it',it),
+                     ('t',t),
+                     ('dt',dt),
+                     ('Rt',Rt),
+                     ('auto_lockdown',auto_lockdown),
+                     ('U',U),
+                     ('D',D),
+                     ('G',G)])
+    for ic,name in enumerate(compartments):
+        snapshot[name] = X[ic]
+    return snapshot
 
-    import os
-    
+#################################################################    
+
+def get_flows():
+    #
+    # All transfers between compartments, as (source, destination, rate, 
+    # time-dependent factor). The flux is rate*factor*source, per age bin.
+    # Adding a compartment is adding it to `compartments` and its flows here.
+    #
+    nu = fatality_rate_age
+    flows = [('S','E', 1.                   ,'infection'  ),
+             ('S','C', 1.                   ,'lockdown'   ),
+             ('C','S', 1.                   ,'release'    ),
+             ('E','A', (1-p)*sigma          ,''           ),
+             ('E','I',    p *sigma          ,''           ),
+             ('A','I', (1-w)*theta          ,''           ),
+             ('A','R',    w *theta          ,''           ),
+             ('I','Q', gamma                ,''           ),
+             ('Q','H',    q *xi             ,''           ),
+             ('Q','R', (1-q)*xi             ,''           ),
+             ('H','R', (1-nu)*eta           ,''           ),
+             ('H','F',    nu *eta           ,''           ),
+             ('S','V', 1.                   ,'vaccination'),
+             ('W','V', 1.                   ,'vaccination'),
+             ('V','E', 1-vaccine_efficacy   ,'infection'  ),
+             ('W','E', 1.                   ,'infection'  ),
+             ('V','W', 1./Tvaccine_immunity ,''           ),
+             ('R','W', 1./Tnatural_immunity ,''           )]
+    return flows
+
+#################################################################    
+
+flow_terms = ['','infection','lockdown','release','vaccination']
+
+def make_flow_kernel(flows):
+    #
+    # Sparse form of the flows: source index, factor index and rate per flow, 
+    # plus the (compartment x flow) incidence matrix, -1 at the source and 
+    # +1 at the destination. The RHS is then one product (eval_flows).
+    #
+    nflow = len(flows)
+    source      = np.array([compartments.index(flow[0]) for flow in flows])
+    destination = np.array([compartments.index(flow[1]) for flow in flows])
+    incidence   = np.zeros((len(compartments),nflow))
+    incidence[source,np.arange(nflow)]      -= 1.
+    incidence[destination,np.arange(nflow)] += 1.
+    kernel = dict([('source',source),
+                   ('term',np.array([flow_terms.index(flow[3]) for flow in flows])),
+                   ('rate',np.array([flow[2]*np.ones(9) for flow in flows])),
+                   ('incidence',incidence)])
+    return kernel
+
+#################################################################    
+
+def eval_flows(kernel,terms,X):
+    #
+    # X is (compartment x ... x age bin); terms holds the time-dependent 
+    # factors of flow_terms, (term x ... x age bin), the first being ones
+    #
+    rate = kernel['rate'].reshape((len(kernel['rate']),)+(1,)*(X.ndim-2)+(9,))
+    flux = rate*terms[kernel['term']]*X[kernel['source']]
+    return (kernel['incidence'] @ flux.reshape(len(flux),-1)).reshape(X.shape)
+
+#################################################################    
+
+def get_vaccination_rate(pool,ni,G,dt):
+    #
+    # Per-age vaccination rate (per day) of the rollout, for the pool of 
+    # people who can be vaccinated: the susceptible and the waned. The 
+    # removed are immune already. The confined are not vaccinated while 
+    # confined, since V would expose them again (V->E); once released they
+    # are, as susceptible. G holds the doses given so far, and each age bin
+    # gets doses until they cover vaccine_uptake of its people, or the pool
+    # runs out, in the order of vaccination_priority, within 
+    # vaccination_rate doses a day. Works on (... x age bin) arrays.
+    #
+    eligible  = np.minimum(np.maximum(vaccine_uptake*ni - G,0.),pool)
+    wanted    = eligible[...,vaccination_priority]/dt
+    given     = np.clip(vaccination_rate - (np.cumsum(wanted,axis=-1)-wanted),0.,wanted)
+    doses     = np.zeros(np.shape(pool))
+    doses[...,vaccination_priority] = given
+    return np.where(pool > 0,doses/np.maximum(pool,1e-300),0.)
+
+#################################################################    
+
+def init_healthcare_load(f):
+    #
+    # Running tallies of ICU and hospital demand against capacity. 
+    # Everything is updated step by step, so no trajectory is kept.
+    #
+    load = {}
+    for resource,capacity in [('ICU',f['number_of_icu_beds']),
+                              ('Hospitalized',f['number_of_hospital_beds'])]:
+        if (capacity==''):
+            continue
+        load[resource] = dict([('capacity',capacity),
+                               ('peak',0.),
+                               ('time of peak',0.),
+                               ('peak by age',np.zeros(9)),
+                               ('patient days by age',np.zeros(9)),
+                               ('excess patient days',0.),
+                               ('excess patient days by age',np.zeros(9)),
+                               ('overflow days',0.),
+                               ('overflows',[]),    # (onset, end) pairs 
+                               ('t',None),
+                               ('demand',None)])
+    return load
+
+#################################################################    
+
+def update_healthcare_load(load,snap,N):
+    #
+    # Compare the demand at this snapshot with capacity. Onset and end of 
+    # overflow are found by linear interpolation of the excess demand 
+    # between the last two snapshots, and the excess is integrated with 
+    # the trapezoidal rule over the part of the interval above capacity.
+    #
+    t = snap['t']
+    for resource,key in [('ICU','U'),('Hospitalized','H')]:
+        if resource not in load:
+            continue
+        l = load[resource]
+        demand   = N*snap[key]
+        sdemand  = demand.sum()
+        excess1  = sdemand - l['capacity']
+
+        if (sdemand > l['peak']):
+            l['peak'] = sdemand
+            l['time of peak'] = t
+        l['peak by age'] = np.maximum(l['peak by age'],demand)
+
+        if (l['t'] is not None):
+            t0       = l['t']
+            demand0  = l['demand']
+            excess0  = demand0.sum() - l['capacity']
+            dt       = t - t0
+            l['patient days by age'] += 0.5*(demand0+demand)*dt
+            if (excess0 > 0 and excess1 > 0):
+                tstart,tend = t0,t
+                area = 0.5*(excess0+excess1)*dt
+            elif (excess0 <= 0 and excess1 > 0):
+                tstart = t0 + dt*(-excess0)/(excess1-excess0)
+                tend   = t 
+                area   = 0.5*excess1*(tend-tstart)
+                l['overflows'].append([tstart,None])
+            elif (excess0 > 0 and excess1 <= 0):
+                tstart = t0
+                tend   = t0 + dt*excess0/(excess0-excess1)
+                area   = 0.5*excess0*(tend-tstart)
+                l['overflows'][-1][1] = tend
+            else:
+                tstart,tend,area = t,t,0.
+            if (area > 0):
+                # share the excess among the age bins as the demand at the 
+                # end of the interval
+                share = demand/sdemand if (sdemand > 0) else demand0/demand0.sum()
+                l['excess patient days']        += area
+                l['excess patient days by age'] += area*share
+                l['overflow days']              += tend-tstart
+        elif (excess1 > 0):
+            l['overflows'].append([t,None])
+
+        l['t']      = t
+        l['demand'] = demand
+    return load
+
+#################################################################    
+
+def print_healthcare_load(load):
+    for resource in load:
+        l = load[resource]
+        print(resource+' capacity: ',int(np.round(l['capacity'])))
+        print('  peak demand: ',int(np.round(l['peak'])),' at t = ',int(l['time of peak']),' days')
+        if (len(l['overflows']) == 0):
+            print('  capacity never exceeded')
+            continue
+        for onset,end in l['overflows']:
+            if (end is None):
+                print(f'  over capacity from t = {onset:.1f} days until the end of the run')
+            else:
+                print(f'  over capacity from t = {onset:.1f} to {end:.1f} days')
+        print(f'  days over capacity: {l["overflow days"]:.1f}')
+        print('  excess patient-days: ',int(np.round(l['excess patient days'])))
+        print('  excess patient-days by age: ',np.round(l['excess patient days by age']).astype(int))
+
+#################################################################    
+
+def make_schedule(times,values,interpolation='linear'):
+    #
+    # Piecewise polynomial through the knots (times,values), stored as the 
+    # coefficients of a+b*x+c*x**2+d*x**3, x=t-times[k], on each interval k.
+    # Constant beyond the first and last knots. 
+    #
+    times  = np.asarray(times,dtype=float)
+    values = np.asarray(values,dtype=float)
+    n      = len(times)
+    h      = np.diff(times)
+    coeffs = np.zeros((n,4))
+    coeffs[:,0] = values
+    if (interpolation=='linear'):
+        coeffs[:-1,1] = np.diff(values)/h
+    elif (interpolation=='spline' and n > 2):
+        # natural cubic spline: solve for the second derivatives at the knots
+        M = np.zeros((n,n))
+        rhs = np.zeros(n)
+        M[0,0] = M[n-1,n-1] = 1.
+        for i in range(1,n-1):
+            M[i,i-1:i+2] = [h[i-1],2*(h[i-1]+h[i]),h[i]]
+            rhs[i] = 6*((values[i+1]-values[i])/h[i] - (values[i]-values[i-1])/h[i-1])
+        m = np.linalg.solve(M,rhs)
+        coeffs[:-1,1] = np.diff(values)/h - h*(2*m[:-1]+m[1:])/6
+        coeffs[:-1,2] = m[:-1]/2
+        coeffs[:-1,3] = np.diff(m)/(6*h)
+    elif (interpolation=='spline'):
+        coeffs[:-1,1] = np.diff(values)/h
+    elif (interpolation=='pchip' and n > 2):
+        # monotone cubic Hermite (Fritsch-Carlson): no overshoot between knots
+        delta = np.diff(values)/h
+        m = np.zeros(n)
+        w1 = 2*h[1:]+h[:-1]
+        w2 = h[1:]+2*h[:-1]
+        same = (delta[:-1]*delta[1:] > 0)
+        m[1:-1][same] = (w1+w2)[same]/(w1[same]/delta[:-1][same]+w2[same]/delta[1:][same])
+        for i,j,k in [(0,0,1),(n-1,n-2,n-3)]:
+            # one-sided three-point slope at the ends, kept shape-preserving
+            m[i] = ((2*h[j]+h[k])*delta[j] - h[j]*delta[k])/(h[j]+h[k])
+            if (np.sign(m[i]) != np.sign(delta[j])):
+                m[i] = 0.
+            elif (np.sign(delta[j]) != np.sign(delta[k]) and abs(m[i]) > 3*abs(delta[j])):
+                m[i] = 3*delta[j]
+        coeffs[:-1,1] = m[:-1]
+        coeffs[:-1,2] = (3*delta-2*m[:-1]-m[1:])/h
+        coeffs[:-1,3] = (m[:-1]+m[1:]-2*delta)/h**2
+    elif (interpolation=='pchip'):
+        coeffs[:-1,1] = np.diff(values)/h
+    elif (interpolation!='step'):
+        print("unknown schedule interpolation "+interpolation)
+        sys.exit()
+    schedule = dict([('times',times),
+                     ('coeffs',coeffs),
+                     ('interval',0)])
+    return schedule
+
+#################################################################    
+
+def eval_schedule(schedule,t):
+    #
+    # The interval of the last call is remembered: consecutive calls with 
+    # increasing t stay in it or move to the next one, at constant cost; 
+    # only jumps fall back to a binary search. An array of times (one per
+    # country in RK3_batch) is always a binary search.
+    #
+    times = schedule['times']
+    k     = schedule['interval']
+    n     = len(times)
+    if (np.ndim(t) > 0):
+        k = np.clip(np.searchsorted(times,t,side='right')-1,0,n-1)
+        a,b,c,d = schedule['coeffs'][k].T
+        x = t-times[k]
+        return np.where(t < times[0],schedule['coeffs'][0,0],a+x*(b+x*(c+x*d)))
+    if (t < times[0]):
+        return schedule['coeffs'][0,0]
+    if (t >= times[n-1]):
+        return schedule['coeffs'][n-1,0]
+    if not (times[k] <= t < times[k+1]):
+        if (times[k+1] <= t < times[min(k+2,n-1)]):
+            k = k+1
+        else:
+            k = np.searchsorted(times,t,side='right')-1
+        schedule['interval'] = k
+    a,b,c,d = schedule['coeffs'][k]
+    x = t-times[k]
+    return a+x*(b+x*(c+x*d))
+
+#################################################################    
+
+def read_schedule(file,today):
+    #
+    # Lines of date (m/dd/yy) and value, comma or space separated; 
+    # lines starting with # are skipped
+    #
+    times=[]
+    values=[]
+    with open(file) as g:
+        for line in g:
+            line=line.strip()
+            if (line=='' or line.startswith('#')):
+                continue
+            date,value = line.replace(',',' ').split()[:2]
+            times.append(date_to_time_scl(date,today))
+            values.append(float(value))
+    order = np.argsort(times)
+    return make_schedule(np.array(times)[order],np.array(values)[order],schedule_interpolation)
+
+#################################################################    
+
+def get_scheduled_beta(schedule,t,beta_data):
+    # a spline through the knots can dip below zero; beta cannot
+    if (schedule_kind=='Rt'):
+        return np.maximum(gamma*eval_schedule(schedule,t),0.)
+    elif (schedule_kind=='contact'):
+        return np.maximum(beta_data*eval_schedule(schedule,t),0.)
+    print("unknown schedule kind "+schedule_kind)
+    sys.exit()
+
+#################################################################    
+
+def get_data_beta(dDdt,smuS,sAI):
+    #
+    # beta for which the model deaths follow the observed ones. Downward 
+    # revisions of the cumulative deaths give dD/dt < 0 on some days; beta 
+    # is kept at zero there, and get_timestep takes care of beta=0.
+    #
+    return np.maximum(1/smuS * 1/sAI * dDdt,0.)
+
+def get_timestep(beta,Cdt):
+    #
+    # Cdt times the shortest timescale. With no transmission (beta=0) the 
+    # other rates set it. beta can be an array, one per country.
+    #
+    tbeta = np.divide(1.,beta,out=np.full(np.shape(beta),np.inf),where=(beta > 0))
+    return Cdt*np.minimum(tbeta,np.array([1./sigma,1/eta,1/theta,1/gamma,1/xi]).min())
+
+#################################################################    
+
+def RK3_stream(f,every=1,copy=True):
+    #
+    # Generator version of the integrator. Yields a snapshot of the state
+    # (see make_snapshot) every `every` steps, plus the initial condition 
+    # (it=-1) and the last step. Nothing is stored or written, so the 
+    # consumer decides what to keep; breaking out of the loop stops the run.
+    # copy=False skips copying the state for consumers that do not keep it.
+    #
     N             = f['N']
     D0            = f['D0']
     time_D0       = f['time_D0']
     iD0           = f['index_D0']
     days_past     = f['days past']
     deaths        = f['deaths']    
-    name          = f['name']
     lockdown      = f['lockdown']
     fatality_rate = f['fatality_rate']
-    #hosp_fraction = f['hospitalization_fraction']
-    #icu_fraction  = f['icu_fraction']
-    number_of_icu_beds=f['number_of_icu_beds']
     pop               =f['age']
+    number_of_icu_beds=f['number_of_icu_beds']
     
     alpha_ts   = np.double([0.   , -5./9.  ,-153./128.])
     beta_ts    = np.double([1./3., 15./16. ,   8./15. ])
@@ -668,59 +1533,34 @@ def RK3(f):
     # Deaths reflect infections 1/gamma days past
     #
     E0    = (D0/N)/fatality_rate
-    nu    = fatality_rate_age
 #    
     cases=np.array(deaths[iD0:len(deaths)])
     tpast=days_past[iD0:len(deaths)]
     dDdt = np.gradient((1.0*cases/N),tpast)  
+    dDdt_schedule = make_schedule(tpast,dDdt,'linear')
     beta = R0*gamma
+    beta_data = beta
+    kernel = make_flow_kernel(get_flows())
 #
-# Lists to store the populations 
-#
-    SS=[]  # susceptible
-    CC=[]  # confined
-    EE=[]  # exposed
-    AA=[]  # assymptomatic    
-    II=[]  # infected symptomatic
-    QQ=[]  # isolated
-    HH=[]  # hospitalized 
-    UU=[]  # ICU patients    
-    RR=[]  # removed
-    FF=[]  # dead (fatalities)
-    DD=[]  # dead -- different array for comparison
-    tt=[]  # time
-#
-# Initial values 1/gamma ago  
+# Initial values 1/gamma ago; S,C,... are views of the state array X
 #
-    E=np.zeros(9)
+    X=np.zeros((len(compartments),9))
+    S,C,E,A,I,Q,H,R,F,V,W = X
     E[4]=E0
-    C=np.zeros(9)
-    I=np.repeat(1e-30,9)
-    A=np.zeros(9)
-    Q=np.zeros(9)
-    H=np.zeros(9)
-    R=np.zeros(9)
-    F=np.zeros(9)    
+    I[:]=1e-30
     ni=pop/N
-    S=(1-C-E-A-I-Q-H-R-F) * ni
+    S[:]=(1-X.sum(axis=0)) * ni
     U=np.zeros(9)
     D=np.zeros(9)
+    G=np.zeros(9)
     
 #    
-    sS=sum(S)
-    sE=sum(E)
     sA=sum(A)
     sI=sum(I)
 #
-    dSdt=np.zeros(9)
-    dCdt=np.zeros(9)
-    dEdt=np.zeros(9)
-    dAdt=np.zeros(9)
-    dIdt=np.zeros(9)
-    dQdt=np.zeros(9)    
-    dHdt=np.zeros(9)
-    dRdt=np.zeros(9)
-    dFdt=np.zeros(9)    
+    dXdt=np.zeros((len(compartments),9))
+    dGdt=np.zeros(9)
+    terms=np.ones((len(flow_terms),9))
     
 #  Start the integration
     itmax=100000   
@@ -728,12 +1568,13 @@ def RK3(f):
 #  Use t=0 as the time of first death minus 1/gamma
 #
     t= time_D0-tmu
+    t_prev=t
     ds=0.
+    auto_lockdown=False
 #
-    SS,CC,EE,AA,II,QQ,HH,UU,RR,FF,DD,tt = appendvalues(sS,0.,sE,sA,sI,0.,0.,0.,0.,0.,0.,t,SS,CC,EE,AA,II,QQ,HH,UU,RR,FF,DD,tt)
-    RRt=[R0]
+    yield make_snapshot(-1,t,0.,R0,X,U,D,G,copy=copy)
 
-    today        = datetime.datetime.fromisoformat(np.str(datetime.datetime.today())).timestamp() 
+    today        = datetime.datetime.fromisoformat(str(datetime.datetime.today())).timestamp() 
     
     if (lockdown!=''):
         tlockdown = date_to_time_scl(lockdown,today)
@@ -746,47 +1587,64 @@ def RK3(f):
     else:
         #default to no release
         trelease=1e30
-        
-    tmax = date_to_time_scl(tmax_date,today)
 
-#
-#  Open file for writing
-#
-    dirBase='output'
-    if not os.path.exists(dirBase):
-        os.mkdir(dirBase)
-    #dirName=dirBase+'/'+name
-    #if not os.path.exists(dirName):
-    #    os.mkdir(dirName)    
-    fS = open(dirBase+'/'+name+'_Sfile.dat','w+')
-    fC = open(dirBase+'/'+name+'_Cfile.dat','w+')
-    fE = open(dirBase+'/'+name+'_Efile.dat','w+')
-    fA = open(dirBase+'/'+name+'_Afile.dat','w+')
-    fI = open(dirBase+'/'+name+'_Ifile.dat','w+')
-    fQ = open(dirBase+'/'+name+'_Qfile.dat','w+')
-    fH = open(dirBase+'/'+name+'_Hfile.dat','w+')
-    fU = open(dirBase+'/'+name+'_Ufile.dat','w+')
-    fR = open(dirBase+'/'+name+'_Rfile.dat','w+')    
+    if (vaccination_start!=''):
+        tvaccination=date_to_time_scl(vaccination_start,today)        
+    else:
+        tvaccination=1e30
+
+    if (schedule_file!=''):
+        schedule=read_schedule(schedule_file,today)
+    else:
+        schedule=None
         
-    #print 'it --- t (day) --- dt --- Rt --- S'
-    #f.write("%d %E %E %E %E %E %E %E %E %E %E %E %E\n"%(it,t,dt,Rt,S[0:9]))
+    tmax = date_to_time_scl(tmax_date,today)
     
     for it in np.arange(itmax):
 #                                                                                
         tretarded = t + tmu
         if (tretarded < 0):    
-            dDdt_ = np.interp(tretarded,tpast,dDdt)               
+            dDdt_ = eval_schedule(dDdt_schedule,tretarded)               
             smuS = sum(fatality_rate_age*S)
-            beta = 1/smuS * 1/(sA+sI) * dDdt_ 
+            beta = get_data_beta(dDdt_,smuS,sA+sI)
+            beta_data = beta
+        elif (schedule is not None):
+            beta = get_scheduled_beta(schedule,t,beta_data)
         else:
             beta = beta
         Rt = beta/gamma                      
         
-        dt = Cdt*np.array([1./beta,1./sigma,1/eta,1/theta,1/gamma,1/xi]).min()
+        dt = get_timestep(beta,Cdt)
         dt_beta_ts = [i * dt for i in beta_ts]
         
-        psi1=get_kronecker_delta(t,tlockdown,np.array(tt)[it-1],ampl1,dt)
-        psi2=get_kronecker_delta(t,trelease ,np.array(tt)[it-1],ampl2,dt)        
+        psi1=get_kronecker_delta(t,tlockdown,t_prev,ampl1,dt)
+        psi2=get_kronecker_delta(t,trelease ,t_prev,ampl2,dt)        
+        t_prev=t
+#
+# capacity-triggered lockdown and release, as kicks on top of the scheduled ones.
+# Only in the projection; before that beta is inverted from the observed deaths,
+# which already reflect whatever was done.
+#
+        if (icu_lockdown_fraction!='' and tretarded >= 0):
+            icu_demand = N*sum(U)
+            if (not auto_lockdown and icu_demand > icu_lockdown_fraction*number_of_icu_beds):
+                psi1 = psi1 + ampl1/dt
+                auto_lockdown=True
+            elif (auto_lockdown and icu_release_fraction!='' and 
+                  icu_demand < icu_release_fraction*number_of_icu_beds):
+                psi2 = psi2 + ampl2/dt
+                auto_lockdown=False
+
+        terms[flow_terms.index('lockdown')]    = psi1
+        terms[flow_terms.index('release')]     = psi2
+#
+# vaccination too only acts in the projection: with the deaths inverted for 
+# beta, taking people out of S would only raise beta to kill the others
+#
+        if (t > tvaccination and tretarded >= 0):
+            terms[flow_terms.index('vaccination')] = get_vaccination_rate(S+W,ni,G,dt)
+        else:
+            terms[flow_terms.index('vaccination')] = 0.
 #
 # advance time
 #
@@ -800,55 +1658,104 @@ def RK3(f):
         for itsub in range(3):
             sI=sum(I)
             sA=sum(A)
-            Finf=beta*(sI+sA)
-            for ip in range(9): #subpopulation bins 
-                dSdt[ip]   = alpha_ts[itsub]*dSdt[ip]
-                dCdt[ip]   = alpha_ts[itsub]*dCdt[ip]            
-                dEdt[ip]   = alpha_ts[itsub]*dEdt[ip]
-                dAdt[ip]   = alpha_ts[itsub]*dAdt[ip]            
-                dIdt[ip]   = alpha_ts[itsub]*dIdt[ip]
-                dQdt[ip]   = alpha_ts[itsub]*dQdt[ip]                
-                dHdt[ip]   = alpha_ts[itsub]*dHdt[ip]            
-                dRdt[ip]   = alpha_ts[itsub]*dRdt[ip]
-                dFdt[ip]   = alpha_ts[itsub]*dFdt[ip]                
-                        
-            #dSdt = dSdt - beta*(I+A)*S - psi*S  + phi*C
-            #dCdt = dCdt                + psi*S  - phi*C
-            #dEdt = dEdt + beta*(I+A)*S         -       sigma*E            
-            #dAdt = dAdt                        + (1-p)*sigma*E - theta*A
-            #dIdt = dIdt                        +    p *sigma*E            -   gamma*I
-            #dQdt = dQdt                                                       gamma*I -       xi*Q            
-            #dHdt = dHdt                                                               +    q *xi*Q - eta*H
-            #dRdt = dRdt                                         + theta*A             + (1-q)*xi*Q + eta*H
-
-                dSdt[ip] = dSdt[ip] - Finf*S[ip] - psi1[ip]*S[ip] + psi2[ip]*C[ip]
-                dCdt[ip] = dCdt[ip]              + psi1[ip]*S[ip] - psi2[ip]*C[ip] 
-                dEdt[ip] = dEdt[ip] + Finf*S[ip]                             -       sigma*E[ip]            
-                dAdt[ip] = dAdt[ip]                                          + (1-p)*sigma*E[ip] -       theta*A[ip]
-                dIdt[ip] = dIdt[ip]                                          +    p *sigma*E[ip] + (1-w)*theta*A[ip] - gamma*I[ip]     
-                dQdt[ip] = dQdt[ip]                                                                                  + gamma*I[ip] -           xi*Q[ip]                
-                dHdt[ip] = dHdt[ip]                                                                                                +    q[ip] *xi*Q[ip] -            eta*H[ip]
-                dRdt[ip] = dRdt[ip]                                                              +    w *theta*A[ip]               + (1-q[ip])*xi*Q[ip] + (1-nu[ip])*eta*H[ip]
-                dFdt[ip] = dFdt[ip]                                                                                                                     +    nu[ip] *eta*H[ip]
-
-                S[ip] = S[ip] + dt_beta_ts[itsub]*dSdt[ip]
-                C[ip] = C[ip] + dt_beta_ts[itsub]*dCdt[ip]            
-                E[ip] = E[ip] + dt_beta_ts[itsub]*dEdt[ip]
-                A[ip] = A[ip] + dt_beta_ts[itsub]*dAdt[ip]            
-                I[ip] = I[ip] + dt_beta_ts[itsub]*dIdt[ip]
-                Q[ip] = Q[ip] + dt_beta_ts[itsub]*dQdt[ip]                
-                H[ip] = H[ip] + dt_beta_ts[itsub]*dHdt[ip]            
-                R[ip] = R[ip] + dt_beta_ts[itsub]*dRdt[ip]
-                F[ip] = F[ip] + dt_beta_ts[itsub]*dFdt[ip]
-
-                U[ip] = H[ip]*critical_care_age[ip]
-                D[ip] = fatality_rate_age[ip]*(ni[ip]-(S[ip]+C[ip]))
-                #D[ip] = fatality_rate_age[ip]*E[ip]
-                
-                
-        SS,CC,EE,AA,II,QQ,HH,UU,RR,FF,DD,tt = appendvalues(sum(S),sum(C),sum(E),sum(A),sum(I),sum(Q),sum(H),sum(U),sum(R),sum(F),sum(D),
+            terms[flow_terms.index('infection')] = beta*(sI+sA)
+
+            dXdt = alpha_ts[itsub]*dXdt + eval_flows(kernel,terms,X)
+            dGdt = alpha_ts[itsub]*dGdt + terms[flow_terms.index('vaccination')]*(S+W)
+            X   += dt_beta_ts[itsub]*dXdt
+            G   += dt_beta_ts[itsub]*dGdt
+
+        U[:] = H*critical_care_age
+        D[:] = fatality_rate_age*(ni-(S+C+V))
+#
+        last = ((it == itmax-1) or t > tmax)
+        if (it % every == 0 or last):
+            yield make_snapshot(it,t,dt,Rt,X,U,D,G,auto_lockdown,copy)
+        if (last):
+            break
+
+#################################################################    
+
+def RK3(f,callback=None):
+    #
+    # Full run: stores the totals, writes the age-binned output files and 
+    # prints every step. If a callback is given it is called with every 
+    # snapshot, and the run stops early as soon as it returns True.
+    #
+    import os
+    
+    N             = f['N']
+    name          = f['name']
+#
+# Lists to store the populations 
+#
+    SS=[]  # susceptible
+    CC=[]  # confined
+    EE=[]  # exposed
+    AA=[]  # assymptomatic    
+    II=[]  # infected symptomatic
+    QQ=[]  # isolated
+    HH=[]  # hospitalized 
+    UU=[]  # ICU patients    
+    RR=[]  # removed
+    FF=[]  # dead (fatalities)
+    DD=[]  # dead -- different array for comparison
+    tt=[]  # time
+    VV=[]  # vaccinated
+    WW=[]  # waned immunity
+    GG=[]  # vaccine doses given
+    RRt=[]
+    load=init_healthcare_load(f)
+
+#
+#  Open file for writing
+#
+    dirBase='output'
+    if not os.path.exists(dirBase):
+        os.mkdir(dirBase)
+    #dirName=dirBase+'/'+name
+    #if not os.path.exists(dirName):
+    #    os.mkdir(dirName)    
+    fS = open(dirBase+'/'+name+'_Sfile.dat','w+')
+    fC = open(dirBase+'/'+name+'_Cfile.dat','w+')
+    fE = open(dirBase+'/'+name+'_Efile.dat','w+')
+    fA = open(dirBase+'/'+name+'_Afile.dat','w+')
+    fI = open(dirBase+'/'+name+'_Ifile.dat','w+')
+    fQ = open(dirBase+'/'+name+'_Qfile.dat','w+')
+    fH = open(dirBase+'/'+name+'_Hfile.dat','w+')
+    fU = open(dirBase+'/'+name+'_Ufile.dat','w+')
+    fR = open(dirBase+'/'+name+'_Rfile.dat','w+')    
+    fV = open(dirBase+'/'+name+'_Vfile.dat','w+')
+    fW = open(dirBase+'/'+name+'_Wfile.dat','w+')
+    fG = open(dirBase+'/'+name+'_Gfile.dat','w+')
+        
+    #print 'it --- t (day) --- dt --- Rt --- S'
+    #f.write("%d %E %E %E %E %E %E %E %E %E %E %E %E\n"%(it,t,dt,Rt,S[0:9]))
+    
+    for snap in RK3_stream(f):
+        it = snap['it']
+        t  = snap['t']
+        dt = snap['dt']
+        Rt = snap['Rt']
+        load = update_healthcare_load(load,snap,N)
+        if (it < 0):
+            # initial condition, stored as in the totals only
+            SS,CC,EE,AA,II,QQ,HH,UU,RR,FF,DD,tt = appendvalues(sum(snap['S']),0.,sum(snap['E']),sum(snap['A']),sum(snap['I']),0.,0.,0.,0.,0.,0.,
+                                                                            t,
+                                                                            SS,CC,EE,AA,II,QQ,HH,UU,RR,FF,DD,tt)
+            VV.append(0.)
+            WW.append(0.)
+            GG.append(0.)
+            RRt.append(Rt)
+            continue
+        S,C,E,A,I = snap['S'],snap['C'],snap['E'],snap['A'],snap['I']
+        Q,H,U,R   = snap['Q'],snap['H'],snap['U'],snap['R']
+        SS,CC,EE,AA,II,QQ,HH,UU,RR,FF,DD,tt = appendvalues(sum(S),sum(C),sum(E),sum(A),sum(I),sum(Q),sum(H),sum(U),sum(R),sum(snap['F']),sum(snap['D']),
                                                                         t,
                                                                         SS,CC,EE,AA,II,QQ,HH,UU,RR,FF,DD,tt)
+        VV.append(sum(snap['V']))
+        WW.append(sum(snap['W']))
+        GG.append(sum(snap['G']))
         RRt.append(Rt)
 # 
         write_output(it,t,dt,Rt,fS,S)
@@ -860,23 +1767,35 @@ def RK3(f):
         write_output(it,t,dt,Rt,fH,H)        
         write_output(it,t,dt,Rt,fU,U)
         write_output(it,t,dt,Rt,fR,R)
+        write_output(it,t,dt,Rt,fV,snap['V'])
+        write_output(it,t,dt,Rt,fW,snap['W'])
+        write_output(it,t,dt,Rt,fG,snap['G'])
         print(it,t,dt,Rt,sum(S),sum(C),sum(E),sum(A),sum(I),sum(Q),sum(H),sum(U),sum(R))
 #
-        if ((it == itmax) or t > tmax):
-            print(f'End of simulation at t = {np.int(t):d} days \n')
-            #
-            #  Separate the removed into recovered and dead according to death rate
-            #
-            print(name)
-            print('Percentage infected at peak of epidemics: ',   np.int(np.round(100*np.array(II+AA).max())),'%')
-            print('Number Symptomatic at peak of epidemics: '   ,np.int(np.round(N*np.array(II).max()))) 
-            print('Number Asymptomatic at peak of epidemics: '   ,np.int(np.round(N*np.array(AA).max()))) 
-            print('Number of hospitalized at peak of epidemics: ',np.int(np.round(N*np.array(HH).max())))            
-            print('Number needing ICU at peak of epidemics: ',    np.int(np.round(N*np.array(UU).max())))
-            #print('Total number of deaths' = {np.int(np.round(D*N)):d})
-            #print(f'Total number of deaths averted = {np.int(np.round((D2-D)*N)):d}')
-
+        if (callback is not None and callback(snap)):
+            print(f'Simulation stopped by callback at t = {int(t):d} days \n')
             break
+    else:
+        print(f'End of simulation at t = {int(t):d} days \n')
+    #
+    #  Separate the removed into recovered and dead according to death rate
+    #
+    print(name)
+    print('Percentage infected at peak of epidemics: ',   int(np.round(100*(np.array(II)+np.array(AA)).max())),'%')
+    print('Number Symptomatic at peak of epidemics: '   ,int(np.round(N*np.array(II).max()))) 
+    print('Number Asymptomatic at peak of epidemics: '   ,int(np.round(N*np.array(AA).max()))) 
+    print('Number of hospitalized at peak of epidemics: ',int(np.round(N*np.array(HH).max())))            
+    print('Number needing ICU at peak of epidemics: ',    int(np.round(N*np.array(UU).max())))
+    print_healthcare_load(load)
+    if (vaccination_start!=''):
+        # the rollout should cover vaccine_uptake of every age bin, unless
+        # the bin ran out of susceptible people outside confinement
+        ni = f['age']/N
+        print('Vaccine doses by age (% of the age bin): ',np.round(100*snap['G']/ni).astype(int),
+              ' target: ',int(np.round(100*vaccine_uptake)),'%')
+        print('Vaccinated by age (% of the age bin): ',np.round(100*snap['V']/ni).astype(int))
+    #print('Total number of deaths' = {np.int(np.round(D*N)):d})
+    #print(f'Total number of deaths averted = {np.int(np.round((D2-D)*N)):d}')
             
     results = dict([('Susceptible', SS),
                     ('Confined', CC),
@@ -889,8 +1808,12 @@ def RK3(f):
                     ('Removed', RR),
                     ('Fatalities', FF),                    
                     ('Dead',DD),
+                    ('Vaccinated',VV),
+                    ('Waned',WW),
+                    ('Doses',GG),
                     ('RRt',RRt),
-                    ('Time',tt)])
+                    ('Time',tt),
+                    ('Healthcare load',load)])
 
     fS.close()
     fC.close()
@@ -901,11 +1824,711 @@ def RK3(f):
     fH.close()
     fU.close()
     fR.close() 
+    fV.close()
+    fW.close()
+    fG.close()
+    
+    return results
+
+
+def RK3_summary(f):
+    #
+    # Summary-only run: running peaks and their times, deaths and the 
+    # healthcare load, updated step by step in constant memory. Nothing is 
+    # stored, written or printed; returns a small record.
+    #
+    N = f['N']
+    quantities = dict([('infected',['I','A']),
+                       ('symptomatic',['I']),
+                       ('asymptomatic',['A']),
+                       ('hospitalized',['H']),
+                       ('ICU',['U'])])
+    peak      = dict([(key,0.) for key in quantities])
+    peak_time = dict([(key,0.) for key in quantities])
+    load = init_healthcare_load(f)
+
+    for snap in RK3_stream(f,copy=False):
+        for key in quantities:
+            value = sum(snap[c].sum() for c in quantities[key])
+            if (value > peak[key]):
+                peak[key]      = value
+                peak_time[key] = snap['t']
+        load = update_healthcare_load(load,snap,N)
+
+    record = dict([('name',f['name']),
+                   ('steps',snap['it']+1),
+                   ('end time',snap['t']),
+                   ('peak infected %',100*peak['infected']),
+                   ('time of peak infected',peak_time['infected'])])
+    for key in ['symptomatic','asymptomatic','hospitalized','ICU']:
+        record['peak '+key]         = N*peak[key]
+        record['time of peak '+key] = peak_time[key]
+    # D, the deaths the model is fitted to; F only collects those from H
+    record['deaths']          = N*snap['D'].sum()
+    record['hospital deaths'] = N*snap['F'].sum()
+    # the same fields whether or not a capacity is given, NaN if not
+    for resource in ['ICU','Hospitalized']:
+        if resource in load:
+            record[resource+' overflow days']       = load[resource]['overflow days']
+            record[resource+' excess patient days'] = load[resource]['excess patient days']
+        else:
+            record[resource+' overflow days']       = np.nan
+            record[resource+' excess patient days'] = np.nan
+    return record
+
+#################################################################    
+
+def print_summary(record):
+    print(record['name'])
+    print('Percentage infected at peak of epidemics: ',   int(np.round(record['peak infected %'])),'%')
+    print('Number Symptomatic at peak of epidemics: '   ,int(np.round(record['peak symptomatic']))) 
+    print('Number Asymptomatic at peak of epidemics: '   ,int(np.round(record['peak asymptomatic']))) 
+    print('Number of hospitalized at peak of epidemics: ',int(np.round(record['peak hospitalized'])))            
+    print('Number needing ICU at peak of epidemics: ',    int(np.round(record['peak ICU'])))
+    print('Total number of deaths: ',                     int(np.round(record['deaths'])))
+    print('Number of deaths in hospital: ',               int(np.round(record['hospital deaths'])))
+    for key in record:
+        if (key.endswith('overflow days') and np.isfinite(record[key])):
+            print(key+': ',np.round(record[key],1))
+
+#################################################################    
+
+def write_summary(record,file='output/summary.dat'):
+    #
+    # Appends the record as one line; the header is written with the first.
+    # A file with other columns (e.g. from an older version) is left alone.
+    #
+    keys   = [key for key in record if key != 'name']
+    header = '# name '+' '.join(key.replace(' ','_') for key in keys)+'\n'
+    new    = not os.path.isfile(file)
+    if (not new):
+        with open(file) as g:
+            if (g.readline() != header):
+                print("the columns of "+file+" differ from the record; not appended")
+                return
+    with open(file,'a') as g:
+        if (new):
+            g.write(header)
+        g.write(record['name'].replace(' ','_')+' '+' '.join('%E' % record[key] for key in keys)+'\n')
+
+#################################################################    
+
+def RK3_batch(fs,every=1):
+    #
+    # Integrates several countries at once, with a country axis in front of
+    # the age axis: every state array is (country x age bin). Each country 
+    # keeps its own population, pyramid, lockdown date, ICU beds, fatality 
+    # rate and Rt inversion from its deaths, and also its own time and 
+    # timestep, starting at its first death minus tmu: the steps are those
+    # of RK3_stream for that country, taken side by side. Countries past 
+    # tmax are dropped from the arrays, and their rows repeat the final 
+    # state. Totals are stored every `every` steps and at the last step of 
+    # each country, as (step x country) arrays, time included; nothing is 
+    # written or printed.
+    #
+    nc            = len(fs)
+    names         = [f['name'] for f in fs]
+    N             = np.array([f['N'] for f in fs])
+    D0            = np.array([f['D0'] for f in fs])
+    time_D0       = np.array([f['time_D0'] for f in fs])
+    fatality_rate = np.array([f['fatality_rate'] for f in fs])
+    pop           = np.array([f['age'] for f in fs])
+    number_of_icu_beds = np.array([f['number_of_icu_beds'] for f in fs])
+    #all countries share the JHU dates
+    days_past     = fs[0]['days past']
+    nd            = len(days_past)
+    ic            = np.arange(nc)
+
+    alpha_ts   = np.double([0.   , -5./9.  ,-153./128.])
+    beta_ts    = np.double([1./3., 15./16. ,   8./15. ])
+    Cdt = 0.5
+
+    E0    = (D0/N)/fatality_rate
+#
+# death rates on the common date grid, linear between dates as in 
+# RK3_stream; zero before each country's first death, which is never used
+#
+    dDdt = np.zeros((nc,nd))
+    for k,f in enumerate(fs):
+        iD0 = f['index_D0']
+        cases = np.array(f['deaths'][iD0:nd])
+        dDdt[k,iD0:nd] = np.gradient((1.0*cases/N[k]),days_past[iD0:nd])
+    slope = np.zeros((nc,nd))
+    slope[:,:-1] = np.diff(dDdt,axis=1)/np.diff(days_past)
+    beta = np.repeat(R0*gamma,nc)
+    beta_data = beta
+    kernel = make_flow_kernel(get_flows())
+#
+# Initial values 1/gamma ago; S,C,... are views of the state array X
+#
+    X=np.zeros((len(compartments),nc,9))
+    S,C,E,A,I,Q,H,R,F,V,W = X
+    E[:,4]=E0
+    I[:]=1e-30
+    ni=pop/N[:,None]
+    S[:]=(1-X.sum(axis=0)) * ni
+    U=np.zeros((nc,9))
+    D=np.zeros((nc,9))
+    G=np.zeros((nc,9))
+    
+    # as in RK3_stream, the inversion uses A+I of the start of the last substep
+    sAI=(A+I).sum(axis=1)
+    dXdt=np.zeros((len(compartments),nc,9))
+    dGdt=np.zeros((nc,9))
+    terms=np.ones((len(flow_terms),nc,9))
+
+    itmax=100000   
+    t     = time_D0-tmu
+    t_prev= t
+    ds    = np.zeros(nc)
+    auto_lockdown = np.zeros(nc,dtype=bool)
+    # the countries still integrated, as indices in fs
+    running = np.arange(nc)
+
+    today        = datetime.datetime.fromisoformat(str(datetime.datetime.today())).timestamp() 
+    tlockdown = np.zeros(nc)
+    for k,f in enumerate(fs):
+        if (f['lockdown']!=''):
+            tlockdown[k] = date_to_time_scl(f['lockdown'],today)
+        else:
+            #default to today
+            tlockdown[k] = 0.
+    if (release!=''):
+        trelease=date_to_time_scl(release,today)        
+    else:
+        #default to no release
+        trelease=1e30
+    if (vaccination_start!=''):
+        tvaccination=date_to_time_scl(vaccination_start,today)        
+    else:
+        tvaccination=1e30
+    if (schedule_file!=''):
+        schedule=read_schedule(schedule_file,today)
+    else:
+        schedule=None
+    tmax = date_to_time_scl(tmax_date,today)
+
+    # X, then ICU, dead and doses, each summed over age
+    stored = [np.concatenate([X.sum(axis=2),U.sum(axis=1)[None],D.sum(axis=1)[None],G.sum(axis=1)[None]])]
+    RRt=[beta/gamma]
+    tt=[t]
+    # only the countries still inverting their deaths, or vaccinating, pay for it
+    data = np.ones(nc,dtype=bool)
+    vaccination = flow_terms.index('vaccination')
+    terms[vaccination] = 0.
+    for it in np.arange(itmax):
+        tretarded = t + tmu
+        data  = data & (tretarded < 0)
+        if (data.any()):
+            # the linear interpolation of eval_schedule, for all countries at once
+            k     = np.clip(np.searchsorted(days_past,tretarded,side='right')-1,0,nd-1)
+            dDdt_ = dDdt[ic,k] + (tretarded-days_past[k])*slope[ic,k]
+            smuS  = (fatality_rate_age*S).sum(axis=1)
+            beta_ = get_data_beta(dDdt_,smuS,sAI)
+            beta_data = np.where(data,beta_,beta_data)
+            beta      = np.where(data,beta_,beta)
+        if (schedule is not None):
+            beta = np.where(data,beta,get_scheduled_beta(schedule,t,beta_data))
+        Rt = beta/gamma
+
+        dt = get_timestep(beta,Cdt)
+
+        lock  = ((t-tlockdown > 0) & (t_prev-tlockdown < 0))
+        free  = ((t-trelease  > 0) & (t_prev-trelease  < 0))
+        t_prev= t
+#
+# capacity-triggered lockdown and release, as in RK3_stream
+#
+        if (icu_lockdown_fraction!=''):
+            icu_demand = N*U.sum(axis=1)
+            trigger = (~data & ~auto_lockdown & (icu_demand > icu_lockdown_fraction*number_of_icu_beds))
+            if (icu_release_fraction!=''):
+                untrigger = (~data & auto_lockdown & (icu_demand < icu_release_fraction*number_of_icu_beds))
+            else:
+                untrigger = np.zeros(nc,dtype=bool)
+            lock = lock*1. + trigger
+            free = free*1. + untrigger
+            auto_lockdown = (auto_lockdown | trigger) & ~untrigger
+
+        terms[flow_terms.index('lockdown')] = lock[:,None]*ampl1/dt[:,None]
+        terms[flow_terms.index('release')]  = free[:,None]*ampl2/dt[:,None]
+        vaccinating = (t > tvaccination) & ~data
+        if (vaccinating.any()):
+            terms[vaccination] = vaccinating[:,None]*get_vaccination_rate(S+W,ni,G,dt[:,None])
+        dt_beta_ts = [i * dt for i in beta_ts]
+#
+# advance time
+#
+        for itsub in range(3):
+            ds  = alpha_ts[itsub]*ds
+            ds  = ds+1.
+            t   = t + dt_beta_ts[itsub]*ds
+#
+# advance quantities
+#
+        for itsub in range(3):
+            sAI = (A+I).sum(axis=1)
+            terms[flow_terms.index('infection')] = (beta*sAI)[:,None]
+
+            dXdt = alpha_ts[itsub]*dXdt + eval_flows(kernel,terms,X)
+            dGdt = alpha_ts[itsub]*dGdt + terms[vaccination]*(S+W)
+            X   += dt_beta_ts[itsub][:,None]*dXdt
+            G   += dt_beta_ts[itsub][:,None]*dGdt
+
+        U = H*critical_care_age
+        D = fatality_rate_age*(ni-(S+C+V))
+#
+        done = (t > tmax)
+        last = ((it == itmax-1) or done.all())
+        if (it % every == 0 or last or done.any()):
+            stored.append(stored[-1].copy())
+            stored[-1][:,running] = np.concatenate([X.sum(axis=2),U.sum(axis=1)[None],D.sum(axis=1)[None],G.sum(axis=1)[None]])
+            RRt.append(RRt[-1].copy())
+            RRt[-1][running] = Rt
+            tt.append(tt[-1].copy())
+            tt[-1][running] = t
+        if (last):
+            break
+#
+# drop the countries past tmax
+#
+        if (done.any()):
+            keep    = ~done
+            running = running[keep]
+            t,t_prev,ds,beta,beta_data,data,auto_lockdown = [y[keep] for y in 
+                (t,t_prev,ds,beta,beta_data,data,auto_lockdown)]
+            N,ni,tlockdown,number_of_icu_beds,dDdt,slope,sAI,U,D,G,dGdt = [y[keep] for y in 
+                (N,ni,tlockdown,number_of_icu_beds,dDdt,slope,sAI,U,D,G,dGdt)]
+            X,dXdt,terms = X[:,keep],dXdt[:,keep],terms[:,keep]
+            S,C,E,A,I,Q,H,R,F,V,W = X
+            ic = np.arange(len(running))
+
+    stored = np.array(stored)
+    results = dict([('names',names),('N',np.array([f['N'] for f in fs]))])
+    keys = ['Susceptible','Confined','Exposed','Asymptomatic','Symptomatic','Quarantined',
+            'Hospitalized','Removed','Fatalities','Vaccinated','Waned','ICU','Dead','Doses']
+    for i,key in enumerate(keys):
+        results[key] = stored[:,i]
+    results['RRt']  = np.array(RRt)
+    results['Time'] = np.array(tt)
     
     return results
 
+#################################################################    
+
+def set_parameters(pars):
+    #
+    # Sets input parameters (same names as above) and everything derived 
+    # from them. fac1 applies to the first seven age bins, as in the default 
+    # factor1. The age tables are scaled with fatality_scale, 
+    # hospitalization_scale and critical_care_scale, relative to the 
+    # London study values.
+    #
+    g = globals()
+    scales = dict([('fatality_scale','fatality_rate_age'),
+                   ('hospitalization_scale','hospitalization_fraction_age'),
+                   ('critical_care_scale','critical_care_age')])
+    for key in pars:
+        if key in scales:
+            g[scales[key]] = np.minimum(london_tables[scales[key]]*pars[key],1.)
+        elif (key == 'fac1'):
+            g['fac1']    = pars[key]
+            g['factor1'] = np.array([fac1, fac1, fac1, fac1, fac1, fac1, fac1, 1.0, 1.0])
+        else:
+            g[key] = pars[key]
+    g['sigma']  = 1./Tincubation
+    g['gamma']  = 1./Tinfection
+    g['mu']     = 1./Tdeath  
+    g['eta']    = 1./Thospitalized
+    g['xi']     = 1./Thospitalization
+    g['theta']  = mu
+    g['tmu']    = Tdeath
+    g['ampl1']  = factor1*a
+    g['ampl2']  = factor2*a
+    g['q']      = hospitalization_fraction_age
+    g['gammap'] = gamma + (1-q)*xi
+
+#################################################################    
+
+def evaluate_samples(args):
+    #
+    # Summary-only runs for a block of parameter samples; 
+    # returns peak ICU demand and total deaths for each
+    #
+    f,names,samples = args
+    outputs = np.zeros((len(samples),2))
+    for i,sample in enumerate(samples):
+        set_parameters(dict(zip(names,sample)))
+        g = dict(f)
+        g['fatality_rate'] = get_fatality_rate(f['age'])
+        record = RK3_summary(g)
+        outputs[i] = [record['peak ICU'],record['deaths']]
+    return outputs
+
+#################################################################    
+
+def halton(n,d,skip=20,seed=0):
+    #
+    # Quasi-random points in the unit hypercube, (n x d). The digits are 
+    # scrambled with a random permutation per dimension and digit: plain 
+    # Halton points in the large bases are strongly correlated between 
+    # neighbouring dimensions (0.70 between the last two of 22, at n=256).
+    #
+    rng    = np.random.default_rng(seed)
+    # the first d primes, one base per dimension
+    primes = []
+    candidate = 2
+    while (len(primes) < d):
+        if all(candidate % prime for prime in primes):
+            primes.append(candidate)
+        candidate += 1
+    index  = np.arange(skip+1,skip+n+1)
+    points = np.zeros((n,d))
+    for j in range(d):
+        base = primes[j]
+        k = index.copy()
+        fraction = 1.
+        # down to double precision, so that the leading zeros are scrambled too
+        for digit in range(int(np.ceil(53*np.log(2)/np.log(base)))):
+            fraction /= base
+            points[:,j] += fraction*rng.permutation(base)[k % base]
+            k //= base
+    return points
+
+#################################################################    
+
+def get_sobol_indices(fA,fB,fAB):
+    #
+    # First-order (Saltelli 2010) and total (Jansen 1999) indices, 
+    # from the model outputs on A, B and the k matrices A_B^i
+    #
+    V  = np.var(np.concatenate([fA,fB]))
+    S1 = np.array([np.mean(fB*(fABi-fA)) for fABi in fAB])/V
+    ST = np.array([0.5*np.mean((fA-fABi)**2) for fABi in fAB])/V
+    return S1,ST
+
+#################################################################    
+
+def sensitivity_analysis(f,n=256,ranges=None,processes=None,nbootstrap=200,seed=0):
+    #
+    # Sobol indices of peak ICU demand and total deaths with respect to 
+    # the parameters in `ranges` (name: (low,high)), from n(k+2) runs on 
+    # Saltelli's scheme with scrambled Halton points. Runs are split in blocks over 
+    # `processes` worker processes (all cores by default). Convergence is 
+    # shown by the indices with n/4, n/2 and n base points, and by 
+    # bootstrap 95% intervals.
+    #
+    import time
+    import multiprocessing
+    if (ranges is None):
+        ranges = dict([('Tincubation'          ,(4.   ,7.  )),
+                       ('Tinfection'           ,(2.   ,4.  )),
+                       ('Thospitalization'     ,(3.   ,7.  )),
+                       ('Thospitalized'        ,(7.   ,14. )),
+                       ('Tdeath'               ,(10.  ,18. )),
+                       ('p'                    ,(0.4  ,0.8 )),
+                       ('w'                    ,(0.6  ,0.95)),
+                       ('fac1'                 ,(0.6  ,0.95)),
+                       ('fatality_scale'       ,(0.5  ,2.  )),
+                       ('hospitalization_scale',(0.5  ,2.  )),
+                       ('critical_care_scale'  ,(0.5  ,2.  ))])
+    names = list(ranges.keys())
+    k     = len(names)
+    low   = np.array([ranges[name][0] for name in names])
+    high  = np.array([ranges[name][1] for name in names])
+
+    AB     = halton(n,2*k,seed=seed)
+    A      = low + (high-low)*AB[:,:k]
+    B      = low + (high-low)*AB[:,k:]
+    samples = [A,B]
+    for i in range(k):
+        ABi = A.copy()
+        ABi[:,i] = B[:,i]
+        samples.append(ABi)
+    samples = np.concatenate(samples)
+
+    # to restore the inputs afterwards
+    saved = dict([(key,globals()[key]) for key in names+['factor1']+list(london_tables.keys())
+                  if key in globals()])
+    if (processes is None):
+        processes = multiprocessing.cpu_count()
+    blocks = [(f,names,block) for block in np.array_split(samples,4*processes) if len(block) > 0]
+    start = time.time()
+    try:
+        if (processes > 1):
+            with multiprocessing.get_context('fork').Pool(processes) as pool:
+                outputs = np.concatenate(pool.map(evaluate_samples,blocks))
+        else:
+            outputs = np.concatenate([evaluate_samples(block) for block in blocks])
+    finally:
+        globals().update(saved)
+        set_parameters({})
+    elapsed = time.time()-start
+    print(f'{len(samples):d} runs in {elapsed:.1f} s, {1000*elapsed/len(samples):.1f} s per thousand runs')
+
+    results = dict([('names',names),('samples',samples),('outputs',outputs),('time',elapsed)])
+    for io,output in enumerate(['peak ICU','deaths']):
+        y   = outputs[:,io].reshape(k+2,n)
+        ok  = np.all(np.isfinite(y),axis=0)
+        if (not ok.all()):
+            print(f'{output}: {np.sum(~ok):d} of {n:d} base points discarded (non-finite results)')
+        y   = y[:,ok]
+        m   = y.shape[1]
+        S1,ST = get_sobol_indices(y[0],y[1],y[2:])
+        convergence = [get_sobol_indices(y[0,:m//d],y[1,:m//d],y[2:,:m//d]) for d in [4,2]]
+        rng = np.random.default_rng(0)
+        boot = []
+        for ib in range(nbootstrap):
+            r = rng.integers(0,m,m)
+            boot.append(get_sobol_indices(y[0,r],y[1,r],y[2:,r]))
+        boot = np.array(boot)
+        S1_ci = np.percentile(boot[:,0],[2.5,97.5],axis=0)
+        ST_ci = np.percentile(boot[:,1],[2.5,97.5],axis=0)
+
+        print(output)
+        print('  parameter               S1 (n/4, n/2, n)          95%           ST (n/4, n/2, n)          95%')
+        for i,name in enumerate(names):
+            print(f'  {name:22s}'
+                  f'{convergence[0][0][i]:6.3f} {convergence[1][0][i]:6.3f} {S1[i]:6.3f}  [{S1_ci[0][i]:6.3f},{S1_ci[1][i]:6.3f}]   '
+                  f'{convergence[0][1][i]:6.3f} {convergence[1][1][i]:6.3f} {ST[i]:6.3f}  [{ST_ci[0][i]:6.3f},{ST_ci[1][i]:6.3f}]')
+        results[output] = dict([('S1',S1),('ST',ST),('S1 95%',S1_ci),('ST 95%',ST_ci),
+                                ('S1 n/4',convergence[0][0]),('S1 n/2',convergence[1][0]),
+                                ('ST n/4',convergence[0][1]),('ST n/2',convergence[1][1])])
+    return results
+
+
+def decimate_minmax(t,y,nbins):
+    #
+    # Keeps, in each of nbins chunks of the series, the points where y is 
+    # smallest and largest, plus the first and last points: at most 
+    # 2*nbins+2 points, and no peak is lost at any plotting resolution.
+    #
+    n = len(y)
+    if (n <= 2*nbins+2):
+        return t,y
+    size  = int(np.ceil(n/nbins))
+    pad   = size*nbins-n
+    ypad  = np.concatenate([y,np.repeat(y[-1],pad)]).reshape(nbins,size)
+    start = np.arange(nbins)*size
+    keep  = np.concatenate([[0,n-1],start+ypad.argmin(axis=1),start+ypad.argmax(axis=1)])
+    keep  = np.unique(np.minimum(keep,n-1))
+    return t[keep],y[keep]
+
+#################################################################    
+
+def read_output(name,dirBase='output'):
+    #
+    # Reads back the age-binned files written by RK3; 
+    # returns time, Rt and the total of each compartment. The vaccinated,
+    # waned and doses given (V, W, G) are read when present.
+    #
+    output = {}
+    for X in ['S','C','E','A','I','Q','H','U','R','V','W','G']:
+        file = dirBase+'/'+name+'_'+X+'file.dat'
+        if (X in ['V','W','G'] and not os.path.isfile(file)):
+            continue
+        data = np.loadtxt(file,ndmin=2)
+        output[X] = data[:,4:].sum(axis=1)
+    output['t']  = data[:,1]
+    output['Rt'] = data[:,3]
+    return output
+
+#################################################################    
+
+def is_up_to_date(png,inputs,key=''):
+    #
+    # True if the figure exists, is newer than every file it is made from, 
+    # and was made with the same settings: `key`, kept next to it in .key
+    #
+    if not (os.path.isfile(png) and os.path.isfile(png+'.key')):
+        return False
+    with open(png+'.key') as g:
+        if (g.read() != key):
+            return False
+    return os.path.getmtime(png) > max(os.path.getmtime(file) for file in inputs)
+
+def save_figure(fig,png,key=''):
+    fig.savefig(png,bbox_inches='tight')
+    with open(png+'.key','w') as g:
+        g.write(key)
+
+#################################################################    
+
+def render_country(args):
+    #
+    # Figure of one country from its output files, skipped if it is newer
+    # than them. Uses the Figure API rather than pyplot, so that it can 
+    # run in worker processes.
+    #
+    from matplotlib.figure import Figure
+    name,dirBase,nbins = args
+    png    = dirBase+'/'+name+'.png'
+    inputs = [dirBase+'/'+name+'_'+X+'file.dat' for X in ['S','C','E','A','I','Q','H','U','R','V','W','G']]
+    inputs = [file for file in inputs if os.path.isfile(file)]
+    key    = 'nbins='+str(nbins)
+    if (is_up_to_date(png,inputs,key)):
+        return png
+    output = read_output(name,dirBase)
+    t = output['t']
+    fig = Figure(figsize=(12,10))
+    ax1,ax2 = fig.subplots(2,1,sharex=True,gridspec_kw=dict(height_ratios=[3,1]))
+    labels = dict([('S','Susceptible'),('C','Confined'),('E','Exposed'),('A','Asymptomatic'),
+                   ('I','Symptomatic'),('Q','Quarantined'),('H','Hospitalized'),('U','ICU'),
+                   ('R','Removed'),('V','Vaccinated'),('W','Waned'),('G','Vaccine doses')])
+    for X in labels:
+        # no V, W or G in older output, and no V or G without vaccination
+        if (X not in output or output[X].max() <= 0):
+            continue
+        td,yd = decimate_minmax(t,output[X],nbins)
+        # dashed past the ten colours of the cycle
+        ax1.plot(td,yd,label=labels[X],ls='--' if X in ['V','W','G'] else '-')
+    ax1.set_yscale('log')
+    ax1.set_ylim(1e-7,2)
+    ax1.set_ylabel('Fraction of population')
+    ax1.set_title(name)
+    ax1.legend(loc='lower right',ncol=3,fontsize=SMALL_SIZE)
+    td,yd = decimate_minmax(t,output['Rt'],nbins)
+    ax2.plot(td,yd,color='k')
+    ax2.axhline(1.,ls=':',color='k')
+    ax2.set_ylim(0,5)
+    ax2.set_ylabel(r'$R_t$')
+    ax2.set_xlabel('Days from today')
+    save_figure(fig,png,key)
+    return png
+
+#################################################################    
+
+def render_countries(names,dirBase='output',nbins=500):
+    #
+    # Infected (symptomatic+asymptomatic) and ICU fractions of all countries
+    #
+    from matplotlib.figure import Figure
+    png = dirBase+'/countries.png'
+    key = 'nbins='+str(nbins)+' names='+','.join(names)
+    if (is_up_to_date(png,[dirBase+'/'+name+'_'+X+'file.dat' for name in names for X in ['I','A','U']],key)):
+        return png
+    fig = Figure(figsize=(12,10))
+    ax1,ax2 = fig.subplots(2,1,sharex=True)
+    for name in names:
+        output = read_output(name,dirBase)
+        td,yd = decimate_minmax(output['t'],output['I']+output['A'],nbins)
+        ax1.plot(td,yd,label=name)
+        td,yd = decimate_minmax(output['t'],output['U'],nbins)
+        ax2.plot(td,yd,label=name)
+    ax1.set_yscale('log')
+    ax1.set_ylim(1e-7,1)
+    ax1.set_ylabel('Infected')
+    ax1.legend(loc='lower right',ncol=2,fontsize=SMALL_SIZE)
+    ax2.set_yscale('log')
+    ax2.set_ylim(1e-9,1e-2)
+    ax2.set_ylabel('ICU')
+    ax2.set_xlabel('Days from today')
+    save_figure(fig,png,key)
+    return png
+
+#################################################################    
+
+def read_summaries(file='output/summary.dat'):
+    #
+    # Records appended by write_summary, as a dict of arrays by column. 
+    # Rows that do not match the header are skipped.
+    #
+    with open(file) as g:
+        keys = g.readline().split()[1:]
+        rows = [line.split() for line in g if line.strip() != '']
+    good = [row for row in rows if len(row) == len(keys)]
+    if (len(good) < len(rows)):
+        print(len(rows)-len(good)," rows of "+file+" do not match its header; skipped")
+    summaries = dict([(key,np.array([float(row[i]) for row in good])) 
+                      for i,key in enumerate(keys) if i > 0])
+    summaries['name'] = np.array([row[0] for row in good])
+    return summaries
+
+#################################################################    
+
+def render_ensemble(summaries,dirBase='output'):
+    #
+    # Distributions of peak ICU demand and deaths over the summary records,
+    # by country
+    #
+    from matplotlib.figure import Figure
+    png = dirBase+'/ensemble.png'
+    if (is_up_to_date(png,[dirBase+'/summary.dat'])):
+        return png
+    fig = Figure(figsize=(12,5))
+    axes = fig.subplots(1,2)
+    for ax,key in zip(axes,['peak_ICU','deaths']):
+        for name in np.unique(summaries['name']):
+            values = summaries[key][(summaries['name']==name) & np.isfinite(summaries[key])]
+            if (len(values) > 0):
+                ax.hist(values,bins=30,histtype='step',label=name.replace('_',' '))
+        ax.set_xlabel(key.replace('_',' '))
+    axes[0].set_ylabel('Runs')
+    axes[1].legend(fontsize=SMALL_SIZE)
+    save_figure(fig,png)
+    return png
+
+#################################################################    
+
+def make_report(names=None,dirBase='output',nbins=500,processes=None):
+    #
+    # Figures and an HTML page from the files in dirBase, without running
+    # the model: one figure per country (rendered in parallel, and only if
+    # its output changed), one comparing the countries, and, if there are 
+    # summary records, their distributions and a table.
+    #
+    import glob
+    import multiprocessing
+    if (names is None):
+        names = sorted(os.path.basename(file)[:-len('_Sfile.dat')] 
+                       for file in glob.glob(dirBase+'/*_Sfile.dat'))
+    if (processes is None):
+        processes = min(len(names),multiprocessing.cpu_count())
+    jobs = [(name,dirBase,nbins) for name in names]
+    if (processes > 1):
+        with multiprocessing.get_context('fork').Pool(processes) as pool:
+            pngs = pool.map(render_country,jobs)
+    else:
+        pngs = [render_country(job) for job in jobs]
+    figures = [os.path.basename(png) for png in pngs]
+    if (len(names) > 1):
+        figures.insert(0,os.path.basename(render_countries(names,dirBase,nbins)))
+
+    table = ''
+    if (os.path.isfile(dirBase+'/summary.dat')):
+        summaries = read_summaries(dirBase+'/summary.dat')
+        figures.append(os.path.basename(render_ensemble(summaries,dirBase)))
+        keys  = ['peak_infected_%','peak_hospitalized','peak_ICU','deaths']
+        keys += [key for key in summaries if key.endswith('overflow_days')]
+        table = '<table>\n<tr><th>country</th><th>runs</th>'
+        table += ''.join('<th>'+key.replace('_',' ')+' (median)</th>' for key in keys)+'</tr>\n'
+        for name in np.unique(summaries['name']):
+            mask = (summaries['name']==name)
+            table += '<tr><td>'+name.replace('_',' ')+'</td><td>'+str(mask.sum())+'</td>'
+            table += ''.join('<td>%.4g</td>' % np.nanmedian(summaries[key][mask]) for key in keys)+'</tr>\n'
+        table += '</table>\n'
+
+    with open(dirBase+'/report.html','w') as g:
+        g.write('<html>\n<head><title>SEIR model for COVID-19</title></head>\n<body>\n')
+        g.write('<h1>SEIR model for COVID-19</h1>\n')
+        g.write(table)
+        for figure in figures:
+            g.write('<p><img src="'+figure+'" width="800"></p>\n')
+        g.write('</body>\n</html>\n')
+    print('report written to '+dirBase+'/report.html')
+    return dirBase+'/report.html'
+
 
 # In[8]:
 
 
-RK3(select_country(country_name))
+if (run_mode=='report'):
+    make_report()
+elif (run_mode=='summary'):
+    record=RK3_summary(select_country(country_name))
+    if not os.path.exists('output'):
+        os.mkdir('output')
+    write_summary(record)
+    print_summary(record)
+else:
+    RK3(select_country(country_name))